@@ -1,9 +1,12 @@
 import sys
 import pandas as pd
+import numpy as np
 import json
-import jsbeautifier
 from statsmodels.stats import proportion
 import argparse
+from functools import lru_cache
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
 
 reliability = {
     "AFF2" : False,
@@ -69,6 +72,14 @@ reliability = {
     "XYLT1" : True
 }
 
+# genotype confidence intervals, one "min-max" range per allele
+interval_patterns = {
+    1: r'(?P<lower1>\d+)-(?P<upper1>\d+)',
+    2: r'(?P<lower1>\d+)-(?P<upper1>\d+)/(?P<lower2>\d+)-(?P<upper2>\d+)',
+}
+
+sorted_poplabels = ["amr", "afr", "ami", "asj", "nfe", "fin", "mid", "sas", "eas", "oth"]
+
 def parse_args():
     """
     Parse command line arguments
@@ -78,39 +89,87 @@ def parse_args():
     parser.add_argument("database_json", help="JSON file of STRchive loci database")
     parser.add_argument("gnomad_tsv", help="TSV file with gnomAD genotype data")
     parser.add_argument("output", help="Output JSON file for plotly library")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="Number of processes used to build loci in parallel (default: 1)")
     return parser.parse_args()
 
-def cyclical_variations(motifs):
+@lru_cache(maxsize=None)
+def _cyclical_variations(motifs):
     # builds the set of all possible motifs with a given motif
     # Motifs with N in them are all permuted with combination of all nucleotides
     nucs = ['A', 'C', 'G', 'T']
-    variations = []
+    variations = set()
     for motif in motifs:
+        expanded = {motif}
         if 'N' in motif:
-            for n in nucs:
-                variations += cyclical_variations([motif.replace('N', n)])
-        variations += [motif[-i:]+motif[:-i] for i in range(len(motif))]
-    return variations
+            template = motif.replace('N', '{}')
+            expanded.update(template.format(*nuc) for nuc in product(nucs, repeat=motif.count('N')))
+        for m in expanded:
+            doubled = m + m
+            variations.update(doubled[i:i+len(m)] for i in range(len(m)))
+    return frozenset(variations)
+
+def cyclical_variations(motifs):
+    # cached per distinct list of motifs, as loci often share the same pathogenic motif
+    return _cyclical_variations(tuple(motifs))
+
+
+def min_alleles(intervals, n_alleles=2):
+    """
+    Parses genotype confidence intervals into the minimum size of each allele.
+
+    Args:
+        intervals: Series of genotype confidence intervals (e.g. "10-12/15-20")
+        n_alleles: Number of alleles to parse from each interval
+
+    Returns:
+        list: One int32 array of minimum allele sizes per allele
+    """
+
+    bounds = intervals.str.extract(interval_patterns[n_alleles]).to_numpy(dtype=np.int32)
+    return [np.minimum(bounds[:, 2*i], bounds[:, 2*i+1]) for i in range(n_alleles)]
 
 
 def binomial_ci(x, n, confidence=0.95):
     """
-    Calculates the confidence interval for a binomial proportion.
+    Calculates the Clopper-Pearson confidence interval for binomial proportions.
 
     Args:
-        x: Number of successes
-        n: Number of trials
+        x: Array of number of successes
+        n: Array of number of trials
         confidence: Confidence level (e.g., 0.95 for a 95% CI)
 
     Returns:
-        tuple: Lower and upper bounds of the confidence interval
+        tuple: Arrays of lower and upper bounds of the confidence intervals
     """
-    
-    lower, upper = proportion.proportion_confint(x, n, alpha=1-confidence, method='binom_test')
+
+    x = np.asarray(x)
+    n = np.asarray(n)
+    lower, upper = proportion.proportion_confint(x, np.maximum(n, 1), alpha=1-confidence, method='beta')
+    # no trials tells us nothing about the proportion
+    lower = np.where(n > 0, lower, 0.0)
+    upper = np.where(n > 0, upper, 1.0)
     return lower, upper
 
-def calc_plotdata(sub_df):
-    sorted_poplabels = ["amr", "afr", "ami", "asj", "nfe", "fin", "mid", "sas", "eas", "oth"]
+def population_counts(populations, pathogenic):
+    """
+    Counts samples and pathogenic samples per population.
+
+    Args:
+        populations: Categorical Series of sample populations, with sorted_poplabels as categories
+        pathogenic: Boolean array of pathogenic calls for the same samples
+
+    Returns:
+        tuple: Arrays of sample counts and pathogenic counts, in sorted_poplabels order
+    """
+
+    codes = populations.cat.codes.to_numpy()
+    # populations outside sorted_poplabels have code -1 and are not counted
+    known = codes >= 0
+    counts = np.bincount(codes[known], minlength=len(sorted_poplabels))
+    pcounts = np.bincount(codes[known & pathogenic], minlength=len(sorted_poplabels))
+    return counts, pcounts
+
+def calc_plotdata(counts, pcounts):
     population_labels = {
         "amr": "Admixed American",
         "afr": "African/African American",
@@ -123,151 +182,161 @@ def calc_plotdata(sub_df):
         "sas": "South Asian",
         "oth": "Others",
     }
-    labels = []
-    values = []
-    counts = []
-    xconf_lowerbound = []
-    xconf_upperbound = []
-    for population in sorted_poplabels:
-        labels.append(f'{population_labels[population]}')
-        count = len(sub_df[sub_df['Population']==population])
-        counts.append(count)
-        if True in sub_df[sub_df['Population']==population]['Pathogenic'].unique():
-            pcount = sub_df[sub_df['Population']==population]['Pathogenic'].value_counts()[True]
-            values.append((pcount/count)*100)
-            conf_lower, conf_upper = binomial_ci(pcount, count)
-        else:
-            values.append(0)
-            conf_lower, conf_upper = binomial_ci(0, count, 0.95)
-        xconf_lowerbound.append(conf_lower*100)
-        xconf_upperbound.append(conf_upper*100)
-    
+    labels = [population_labels[population] for population in sorted_poplabels]
+
+    values = np.where(counts > 0, pcounts / np.maximum(counts, 1) * 100, 0)
+
+    conf_lower, conf_upper = binomial_ci(pcounts, counts)
+    xconf_lowerbound = (conf_lower*100).tolist()
+    xconf_upperbound = (conf_upper*100).tolist()
+
+    values = values.tolist()
+    counts = counts.tolist()
     return [values, labels, counts, xconf_lowerbound, xconf_upperbound]
 
-def build_JSON(args):
-    json_txt = ""
-    with open(args.database_json) as fh:
-        for line in fh: json_txt += line.strip()
-    strchive_info = json.loads(json_txt)
-    
-    df = pd.read_csv(args.gnomad_tsv, sep='\t')
+def process_locus(info, gene, sub_df):
+    """
+    Builds the plot data of a single locus from its gnomAD genotypes.
 
-    plot_data = {}
-    for info in strchive_info:
-        
-        reliable = False
+    Args:
+        info: STRchive locus entry
+        gene: gnomAD gene name of the locus
+        sub_df: DataFrame of gnomAD genotypes for the gene
 
-        # looks for gnomad specific gene name otherwise takes the default gene name
-        try: gene = info['gnomad'][0]
-        except IndexError: gene = info['gene']
+    Returns:
+        dict: Plot data for each sex panel and the locus reliability
+    """
 
-        if gene in reliability: reliable = reliability[gene]
-        else: reliable = False
-        
-        sub_df = df[df['Id'] == gene]
-        
-        # gene is not in gnomAD dataset
-        if len(sub_df) == 0: continue
+    if gene in reliability: reliable = reliability[gene]
+    else: reliable = False
 
-        chrom = info['chrom']
-        pathogenic_motif = info['pathogenic_motif_reference_orientation']
-        try: inheritance = info['inheritance'][0]
-        except IndexError: inheritance = ''
-        
-        pathogenic_min = info['pathogenic_min']
-        pathogenic_max = info['pathogenic_max']
-        
-        prevalence = None
-        if info['prevalence'] is not None: prevalence = (float(info['prevalence'].split('/')[0].strip())/float(info['prevalence'].split('/')[1].strip()))*100
-
-        if chrom == 'chrX':
-            sub_df_XX = sub_df[sub_df['Sex'] == 'XX']
-            sub_df_XX = sub_df_XX.assign(MinAllele1  = sub_df_XX["GenotypeConfidenceInterval"].apply(lambda x: min([int(a) for a in x.split('/')[0].split('-')])))
-            sub_df_XX = sub_df_XX.assign(MinAllele2  = sub_df_XX["GenotypeConfidenceInterval"].apply(lambda x: min([int(a) for a in x.split('/')[1].split('-')])))
-            sub_df_XX = sub_df_XX.assign(Pathogenic1 = [pathogenic_min < x  for i, x in enumerate(sub_df_XX['MinAllele1'])])
-            sub_df_XX = sub_df_XX.assign(Pathogenic2 = [pathogenic_min < x  for i, x in enumerate(sub_df_XX['MinAllele2'])])
-            sub_df_XX = sub_df_XX.assign(PathogenicMotif = [ x in cyclical_variations(pathogenic_motif) for x in sub_df_XX['Motif']])
-
-            sub_df_XY = sub_df[sub_df['Sex'] == 'XY']
-            sub_df_XY = sub_df_XY.assign(MinAllele1  = sub_df_XY["GenotypeConfidenceInterval"].apply(lambda x: min([int(a) for a in x.split('/')[0].split('-')])))
-            sub_df_XY = sub_df_XY.assign(MinAllele2  = 'NA')
-            sub_df_XY = sub_df_XY.assign(Pathogenic1 = [pathogenic_min < x  for i, x in enumerate(sub_df_XY['MinAllele1'])])
-            sub_df_XY = sub_df_XY.assign(Pathogenic2  = 'NA')
-            sub_df_XY = sub_df_XY.assign(PathogenicMotif = [x in cyclical_variations(pathogenic_motif) for x in sub_df_XY['Motif']])
-            
-            if inheritance == 'XD':
-                sub_df_XX['Pathogenic'] = sub_df_XX['Pathogenic1'] | sub_df_XX['Pathogenic2']
-                sub_df_XY['Pathogenic'] = sub_df_XY['Pathogenic1']
-                sub_df = pd.concat([sub_df_XX, sub_df_XY])
-
-            elif inheritance == 'XR':
-                sub_df_XX['Pathogenic'] = sub_df_XX['Pathogenic1'] & sub_df_XX['Pathogenic2']
-                sub_df_XY['Pathogenic'] = sub_df_XY['Pathogenic1']
-                sub_df = pd.concat([sub_df_XX, sub_df_XY])
-            
-            plot_data[info["id"]] = {'XX': "", 'XY': "", 'both': ""}
-
-            for sex, plot_df in zip(['XX', 'XY'], [sub_df_XX, sub_df_XY]):
-                values, labels, counts, xconf_lowerbound, xconf_upperbound = calc_plotdata(plot_df)
-                plot_data[info["id"]][sex] = {
-                    "id": info["id"],
-                    "labels": labels,
-                    "values": values,
-                    "counts": counts,
-                    "confidence_lower_bounds": xconf_lowerbound,
-                    "confidence_upper_bounds": xconf_upperbound,
-                    "title": gene+"_"+sex
-                }
-
-            sub_df = pd.concat([sub_df_XX, sub_df_XY])
-            values, labels, counts, xconf_lowerbound, xconf_upperbound = calc_plotdata(sub_df)
-
-            plot_data[info["id"]]["both"] = {
+    chrom = info['chrom']
+    pathogenic_motif = info['pathogenic_motif_reference_orientation']
+    motif_set = cyclical_variations(pathogenic_motif)
+    try: inheritance = info['inheritance'][0]
+    except IndexError: inheritance = ''
+
+    pathogenic_min = info['pathogenic_min']
+    pathogenic_max = info['pathogenic_max']
+
+    prevalence = None
+    if info['prevalence'] is not None: prevalence = (float(info['prevalence'].split('/')[0].strip())/float(info['prevalence'].split('/')[1].strip()))*100
+
+    if chrom == 'chrX':
+        sub_df_XX = sub_df[sub_df['Sex'] == 'XX']
+        min_allele1, min_allele2 = min_alleles(sub_df_XX["GenotypeConfidenceInterval"])
+        if inheritance == 'XD':
+            pathogenic_XX = (min_allele1 > pathogenic_min) | (min_allele2 > pathogenic_min)
+        elif inheritance == 'XR':
+            pathogenic_XX = (min_allele1 > pathogenic_min) & (min_allele2 > pathogenic_min)
+
+        # XY samples have a single X allele
+        sub_df_XY = sub_df[sub_df['Sex'] == 'XY']
+        min_allele1, = min_alleles(sub_df_XY["GenotypeConfidenceInterval"], n_alleles=1)
+        pathogenic_XY = min_allele1 > pathogenic_min
+
+        plot_entry = {'XX': "", 'XY': "", 'both': ""}
+
+        total_counts, total_pcounts = 0, 0
+        for sex, populations, pathogenic in zip(['XX', 'XY'], [sub_df_XX['Population'], sub_df_XY['Population']], [pathogenic_XX, pathogenic_XY]):
+            counts, pcounts = population_counts(populations, pathogenic)
+            total_counts, total_pcounts = total_counts + counts, total_pcounts + pcounts
+            values, labels, counts, xconf_lowerbound, xconf_upperbound = calc_plotdata(counts, pcounts)
+            plot_entry[sex] = {
                 "id": info["id"],
                 "labels": labels,
                 "values": values,
                 "counts": counts,
                 "confidence_lower_bounds": xconf_lowerbound,
                 "confidence_upper_bounds": xconf_upperbound,
-                "title": gene
+                "title": gene+"_"+sex
             }
-            plot_data[info["id"]]["reliable"] = reliable
-        
+
+        # XX and XY samples are disjoint, so the combined panel is the sum of both
+        values, labels, counts, xconf_lowerbound, xconf_upperbound = calc_plotdata(total_counts, total_pcounts)
+
+        plot_entry["both"] = {
+            "id": info["id"],
+            "labels": labels,
+            "values": values,
+            "counts": counts,
+            "confidence_lower_bounds": xconf_lowerbound,
+            "confidence_upper_bounds": xconf_upperbound,
+            "title": gene
+        }
+        plot_entry["reliable"] = reliable
+
+    else:
+        min_allele1, min_allele2 = min_alleles(sub_df["GenotypeConfidenceInterval"])
+        if gene == 'VWA1':
+            pathogenic1 = min_allele1 != info['benign_min']
+            pathogenic2 = min_allele2 != info['benign_min']
         else:
-            sub_df = sub_df.assign(MinAllele1  = sub_df["GenotypeConfidenceInterval"].apply(lambda x: min([int(a) for a in x.split('/')[0].split('-')])))
-            sub_df = sub_df.assign(MinAllele2  = sub_df["GenotypeConfidenceInterval"].apply(lambda x: min([int(a) for a in x.split('/')[1].split('-')])))
-
-            if gene == 'VWA1':
-                sub_df = sub_df.assign(Pathogenic1 = [info['benign_min'] != x  for i, x in enumerate(sub_df['MinAllele1'])])
-                sub_df = sub_df.assign(Pathogenic2 = [info['benign_min'] != x  for i, x in enumerate(sub_df['MinAllele2'])])
-            else:
-                sub_df = sub_df.assign(Pathogenic1 = [pathogenic_min < x  for i, x in enumerate(sub_df['MinAllele1'])])
-                sub_df = sub_df.assign(Pathogenic2 = [pathogenic_min < x  for i, x in enumerate(sub_df['MinAllele2'])])
-            sub_df = sub_df.assign(PathogenicMotif = [x in cyclical_variations(pathogenic_motif) for x in sub_df['Motif']])
-            
-            if   inheritance == 'AD': sub_df = sub_df.assign(Pathogenic = (sub_df['Pathogenic1'] | sub_df['Pathogenic2']) & sub_df['PathogenicMotif'])
-            elif inheritance == 'AR': sub_df = sub_df.assign(Pathogenic = (sub_df['Pathogenic1'] & sub_df['Pathogenic2']) & sub_df['PathogenicMotif'])
+            pathogenic1 = min_allele1 > pathogenic_min
+            pathogenic2 = min_allele2 > pathogenic_min
+        motif_match = sub_df['Motif'].isin(motif_set).to_numpy()
+
+        if   inheritance == 'AD': pathogenic = (pathogenic1 | pathogenic2) & motif_match
+        elif inheritance == 'AR': pathogenic = (pathogenic1 & pathogenic2) & motif_match
+
+        values, labels, counts, xconf_lowerbound, xconf_upperbound = calc_plotdata(*population_counts(sub_df['Population'], pathogenic))
+
+        plot_entry = {
+            "both": {
+                "id": info["id"],
+                "labels": labels,
+                "values": values,
+                "counts": counts,
+                "confidence_lower_bounds": xconf_lowerbound,
+                "confidence_upper_bounds": xconf_upperbound,
+                "title": gene
+            },
+            "reliable": reliable
+        }
+
+    return plot_entry
+
+def build_JSON(args):
+    with open(args.database_json) as fh:
+        strchive_info = json.load(fh)
+    
+    # multi-threaded Arrow parser, reading only the columns used below
+    df = pd.read_csv(args.gnomad_tsv, sep='\t', engine='pyarrow', dtype_backend='pyarrow',
+                     usecols=['Id', 'Sex', 'Population', 'GenotypeConfidenceInterval', 'Motif'])
+    # categorical columns make the per-locus population grouping and sex filtering cheap
+    df['Population'] = pd.Categorical(df['Population'], categories=sorted_poplabels)
+    df['Sex'] = pd.Categorical(df['Sex'], categories=['XX', 'XY'])
+    # split the genotypes by gene once rather than scanning the whole table for every locus,
+    # keeping only the per-sample columns in each gene's frame
+    gene_groups = dict(iter(df.drop(columns='Id').groupby(df['Id'], sort=False)))
+
+    loci, genes, sub_dfs = [], [], []
+    for info in strchive_info:
+
+        # looks for gnomad specific gene name otherwise takes the default gene name
+        try: gene = info['gnomad'][0]
+        except IndexError: gene = info['gene']
+
+        sub_df = gene_groups.get(gene)
         
-            values, labels, counts, xconf_lowerbound, xconf_upperbound = calc_plotdata(sub_df)
-            
-            plot_data[info["id"]] = {
-                "both": {
-                    "id": info["id"],
-                    "labels": labels,
-                    "values": values,
-                    "counts": counts,
-                    "confidence_lower_bounds": xconf_lowerbound,
-                    "confidence_upper_bounds": xconf_upperbound,
-                    "title": gene
-                },
-                "reliable": reliable
-            }
+        # gene is not in gnomAD dataset
+        if sub_df is None or len(sub_df) == 0: continue
+
+        loci.append(info)
+        genes.append(gene)
+        sub_dfs.append(sub_df)
+
+    # loci are independent, so they can be processed in parallel
+    if args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            plot_entries = list(executor.map(process_locus, loci, genes, sub_dfs))
+    else:
+        plot_entries = list(map(process_locus, loci, genes, sub_dfs))
+
+    plot_data = {info["id"]: plot_entry for info, plot_entry in zip(loci, plot_entries)}
   
     with open(args.output, "w") as file:
-        options = jsbeautifier.default_options()
-        options.indent_size = 2
-        options.brace_style="expand"
-        file.write(jsbeautifier.beautify(json.dumps(plot_data), options))
+        json.dump(plot_data, file, indent=2)
 
 if __name__ == "__main__":
     args = parse_args()